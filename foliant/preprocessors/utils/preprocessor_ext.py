@@ -1,15 +1,35 @@
+import logging
+import mmap
+import os
 import traceback
 import re
 
+from concurrent.futures import ProcessPoolExecutor
+from fnmatch import fnmatch
+from functools import wraps
 from pathlib import Path, PosixPath
+from typing import Union
 
 # from yaml import add_constructor
 
+try:
+    import regex
+except ImportError:
+    regex = None
+
 from foliant.preprocessors.base import BasePreprocessor
 from foliant.utils import output
 # from foliant.meta.generate import load_meta, get_meta_for_chapter
 
-OptionValue = int or float or bool or str
+OptionValue = Union[int, float, bool, str]
+
+if regex is None:
+    _MATCH_TYPES = (re.Match,)
+else:
+    _MATCH_TYPES = (re.Match, regex.Match)
+
+# tag names which are matched literally when put into a pattern
+_PLAIN_TAG_NAME = re.compile(r'[\w:-]+')
 
 
 def allow_fail(msg='Failed to process tag. Skipping.'):
@@ -20,11 +40,12 @@ def allow_fail(msg='Failed to process tag. Skipping.'):
     If first positional argument is a match object, it is passed as context.
     """
     def decorator(func):
+        @wraps(func)
         def wrapper(self, *args, **kwargs):
             try:
                 return func(self, *args, **kwargs)
             except Exception as e:
-                if isinstance(args[0], re.Match):
+                if isinstance(args[0], _MATCH_TYPES):
                     self._warning(f'{msg} {e}',
                                   context=self.get_tag_context(args[0]),
                                   error=e)
@@ -36,6 +57,127 @@ def allow_fail(msg='Failed to process tag. Skipping.'):
     return decorator
 
 
+def _walk_md(root):
+    """
+    Recursively yield paths of all Markdown-files in the root dir.
+
+    Works like Path.rglob('*.md') but uses os.scandir, which gets file types
+    from the directory listing without an extra stat call per entry. Like
+    rglob, it matches names case-insensitively where the OS does (Windows),
+    doesn't follow symlinks to directories and skips directories which can't
+    be listed.
+    """
+    subdirs = []
+    try:
+        entries = os.scandir(root)
+    except PermissionError:
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif fnmatch(entry.name, '*.md') and entry.is_file():
+                yield Path(entry.path)
+    for subdir in subdirs:
+        yield from _walk_md(subdir)
+
+
+def _get_tag_literals(pattern, tags) -> tuple:
+    """
+    Get UTF-8 encoded literals, one of which must be present in text for the
+    tag pattern to match, e.g. (b'<include', b'<plantuml').
+
+    Only the pattern BasePreprocessor builds from tags is recognized: its
+    source and flags must be exactly the same. For any other pattern an empty
+    tuple is returned.
+    """
+    if not tags or not all(_PLAIN_TAG_NAME.fullmatch(tag) for tag in tags):
+        return ()
+    # same as in BasePreprocessor.__init__
+    core_pattern = re.compile(
+        rf'(?<!\<)\<(?P<tag>{"|".join(tags)})' +
+        r'(\s(?P<options>[^\<\>]*))?\>' +
+        r'(?P<body>.*?)\<\/(?P=tag)\>',
+        flags=re.DOTALL
+    )
+    if not isinstance(pattern, re.Pattern) or \
+            pattern.pattern != core_pattern.pattern or \
+            pattern.flags != core_pattern.flags:
+        return ()
+    return tuple(f'<{tag}'.encode('utf8') for tag in tags)
+
+
+def _read_if_contains(path, literals):
+    """
+    Read the text file if it contains any of the byte literals, otherwise
+    return None.
+
+    The file is memory-mapped for the check, so files without the literals
+    are neither copied into memory nor decoded. Other files are decoded
+    straight from the mapping, without an intermediate bytes copy. Newlines
+    are translated the same way as when reading in text mode.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if not any(mm.find(literal) != -1 for literal in literals):
+                return None
+            with memoryview(mm) as view:
+                content = str(view, 'utf8')
+    if '\r' in content:
+        content = content.replace('\r\n', '\n').replace('\r', '\n')
+    return content
+
+
+def _compile_with_regex(pattern):
+    """
+    Recompile the re pattern with the regex package, which supports
+    timeouts for search functions.
+    """
+    if isinstance(pattern, regex.Pattern):
+        return pattern
+    flags = 0
+    for flag in ('IGNORECASE', 'LOCALE', 'MULTILINE', 'DOTALL', 'UNICODE',
+                 'VERBOSE', 'ASCII'):
+        if pattern.flags & getattr(re, flag):
+            flags |= getattr(regex, flag)
+    return regex.compile(pattern.pattern, flags)
+
+
+# preprocessor and tag function of the current worker process
+_worker_preprocessor = None
+_worker_func = None
+
+
+def _init_worker(preprocessor, func_name):
+    """
+    Set up a worker process of the pool.
+
+    The preprocessor (with its compiled pattern) is passed once per worker:
+    with fork start method it is inherited without pickling, with spawn it
+    is pickled once instead of once per task.
+    """
+    global _worker_preprocessor, _worker_func
+    _worker_preprocessor = preprocessor
+    _worker_func = getattr(preprocessor, func_name)
+
+
+def _process_file_in_worker(markdown_file_path):
+    """
+    Process tags of one Markdown-file in a worker process.
+
+    Returns processed text of the file (or None) and the list of warnings
+    issued while processing it.
+    """
+    _worker_preprocessor._deferred_warnings = []
+    processed_content = _worker_preprocessor._process_tags_for_file(
+        _worker_func,
+        markdown_file_path
+    )
+    return processed_content, _worker_preprocessor._deferred_warnings
+
+
 class BasePreprocessorExt(BasePreprocessor):
     """Extension of BasePreprocessor with useful helper methods"""
 
@@ -46,9 +188,24 @@ class BasePreprocessorExt(BasePreprocessor):
         self.current_pos = 0
         self.current_func = None
         self.buffer = {}
+        self._deferred_warnings = None
+        self._literal_prefilter = ()
+        self._tag_pattern = None
+        self._search_options = {}
         # self.meta = load_meta(self.config['chapters'], self.working_dir)
         # add_constructor('!meta', self._resolve_meta_tag)
 
+    def __getstate__(self):
+        '''
+        Drop processing state when the preprocessor is pickled for pool
+        workers: it may hold unpicklable objects and is not used there.
+        '''
+        state = self.__dict__.copy()
+        state['current_func'] = None
+        state['buffer'] = {}
+        state['_deferred_warnings'] = None
+        return state
+
     @staticmethod
     def get_tag_context(match, limit=100, full_tag=False):
         '''
@@ -62,18 +219,19 @@ class BasePreprocessorExt(BasePreprocessor):
         '''
 
         source = match.string
-        start = max(0, match.start() - limit)  # index of context start
-        end = min(len(source), match.end() + limit)  # index of context end
-        span = match.span()  # indeces of match (start, end)
-        result = '...' if start != 0 else ''  # add ... at beginning if cropped
-        if span[1] - span[0] > limit and not full_tag:  # if tag contents longer than limit
-            bp1 = match.start() + limit // 2
-            bp2 = match.end() - limit // 2
-            result += f'{source[start:bp1]} <...> {source[bp2:end]}'
+        match_start, match_end = match.start(), match.end()
+        source_len = len(source)
+        start = max(0, match_start - limit)  # index of context start
+        end = min(source_len, match_end + limit)  # index of context end
+        prefix = '...' if start != 0 else ''  # add ... at beginning if cropped
+        suffix = '...' if end != source_len else ''  # add ... at the end if cropped
+        if match_end - match_start > limit and not full_tag:  # if tag contents longer than limit
+            half = limit // 2
+            bp1 = match_start + half
+            bp2 = match_end - half
+            result = f'{prefix}{source[start:bp1]} <...> {source[bp2:end]}{suffix}'
         else:
-            result += source[start:end]
-        if end != len(source):  # add ... at the end if cropped
-            result += '...'
+            result = f'{prefix}{source[start:end]}{suffix}'
         return result
 
     # def _resolve_meta_tag(self, _, node) -> str:
@@ -96,35 +254,108 @@ class BasePreprocessorExt(BasePreprocessor):
                              specified — will be logged. If debug = True it
                              will also go to STDOUT.
         '''
-        output_message = ''
+        parts = []
         if self.current_filename:
-            output_message += f'[{self.current_filename}] '
-        output_message += msg + '\n'
-        log_message = output_message
-        if context:
-            log_message += f'Context:\n---\n{context}\n---\n'
-        if error:
-            tb_str = traceback.format_exception(etype=type(error),
-                                                value=error,
-                                                tb=error.__traceback__)
-            log_message += '\n'.join(tb_str)
+            parts.append(f'[{self.current_filename}] ')
+        parts.append(msg)
+        parts.append('\n')
+        output_message = log_message = ''.join(parts)
+        # context and traceback are only needed if someone will see them
+        if self.logger.isEnabledFor(logging.WARNING) or \
+                (self.debug and not self.quiet):
+            if context:
+                parts.append(f'Context:\n---\n{context}\n---\n')
+            if error:
+                tb = traceback.TracebackException(type(error),
+                                                  error,
+                                                  error.__traceback__,
+                                                  lookup_lines=False)
+                parts.extend(tb.format())
+            log_message = ''.join(parts)
         if self.debug:
             output_message = log_message
-        output(f'WARNING: {output_message}', self.quiet)
+        self._emit_warning(output_message, log_message)
+
+    def _emit_warning(self, output_message: str, log_message: str):
+        '''
+        Print and log the warning built by _warning.
+
+        In worker processes warnings are collected instead, to be emitted by
+        the main process in file order.
+        '''
+        if self._deferred_warnings is not None:
+            self._deferred_warnings.append((output_message, log_message))
+            return
+        if not self.quiet:
+            output(f'WARNING: {output_message}')
         self.logger.warning(log_message)
 
     def pos_injector(self, block):
         self.current_pos = block.start()
         return self.current_func(block)
 
+    def _set_current_file(self, path: Path):
+        '''Remember the file being processed for warnings and tag functions.'''
+        self.current_filepath = path
+        self.current_filename = str(path.relative_to(self.working_dir))
+
     def save_file(self, path, content):
-        with open(path, 'w', encoding='utf8') as f:
-            f.write(content)
+        Path(path).write_text(content, encoding='utf8')
+
+    def _process_tags_for_file(self, func, markdown_file_path):
+        '''
+        Apply function func to all tags in one Markdown-file.
+
+        Returns processed text of the file or None if the file was not changed.
+        '''
+        self._set_current_file(markdown_file_path)
+
+        if self._literal_prefilter:
+            content = _read_if_contains(markdown_file_path,
+                                        self._literal_prefilter)
+            if content is None:
+                return None
+        else:
+            content = markdown_file_path.read_text(encoding='utf8')
+
+        pattern = self._tag_pattern or self.pattern
+        try:
+            first_match = pattern.search(content, **self._search_options)
+            if first_match is None:
+                return None
+            matches = list(pattern.finditer(content,
+                                            first_match.start(),
+                                            **self._search_options))
+        except TimeoutError:
+            self._warning('Tag search timed out after '
+                          f'{self._search_options["timeout"]} s. '
+                          'File left unchanged.')
+            return None
+
+        self.current_func = func
+        self.current_pos = 0
+        parts = []
+        last = 0
+        for match in matches:
+            start = match.start()
+            parts.append(content[last:start])
+            self.current_pos = start
+            replacement = func(match)
+            if replacement is not None:
+                parts.append(replacement)
+            last = match.end()
+        parts.append(content[last:])
+        processed_content = ''.join(parts)
+        if processed_content == content:
+            return None
+        return processed_content
 
     def _process_tags_for_all_files(self,
                                     func,
                                     log_msg: str = 'Applying preprocessor',
-                                    buffer: bool = False):
+                                    buffer: bool = False,
+                                    workers: int = 1,
+                                    timeout: float = None):
         '''
         Apply function func to all Markdown-files in the working dir
 
@@ -133,49 +364,87 @@ class BasePreprocessorExt(BasePreprocessor):
         :param log_msg: message text which will be logged at the beginning
         :param buffer: if True, processed text of each file will be buffered and
                        at the end all files will be saved at once.
+        :param workers: number of processes to distribute files between. If
+                        more than 1, func must be a method of the preprocessor
+                        and the preprocessor must be picklable.
+        :param timeout: max time in seconds to search for tags in one file. If
+                        exceeded, the file is left unchanged. Requires the
+                        regex package.
         '''
         self.logger.info(log_msg)
-        for markdown_file_path in self.working_dir.rglob('*.md'):
-            self.current_filepath = Path(markdown_file_path)
-            self.current_filename = str(self.current_filepath.
-                                        relative_to(self.working_dir))
-
-            with open(markdown_file_path,
-                      encoding='utf8') as markdown_file:
-                content = markdown_file.read()
-
-            self.current_func = func
-            self.current_pos = 0
-            processed_content = self.pattern.sub(self.pos_injector, content)
-
+        self._literal_prefilter = _get_tag_literals(self.pattern, self.tags)
+        self._tag_pattern = None
+        self._search_options = {}
+        if timeout is not None:
+            if regex is None:
+                self._warning('Package regex is not installed, '
+                              'timeout is ignored')
+            else:
+                self._tag_pattern = _compile_with_regex(self.pattern)
+                self._search_options = {'timeout': timeout}
+        func_name = getattr(func, '__name__', None)
+        if workers > 1 and (func_name is None or
+                            getattr(self, func_name, None) != func):
+            self.logger.debug('func is not a method of the preprocessor, '
+                              'processing files serially')
+            workers = 1
+        if workers > 1:
+            results = self._process_tags_in_pool(func, workers)
+        else:
+            results = (
+                (path, self._process_tags_for_file(func, path))
+                for path in _walk_md(self.working_dir)
+            )
+        for markdown_file_path, processed_content in results:
             if isinstance(processed_content, str):
                 if buffer:
                     self.buffer[markdown_file_path] = processed_content
                 else:
                     self.save_file(markdown_file_path, processed_content)
         self.current_filename = ''
+        self.current_func = None
+        self.current_pos = 0
 
         for path, content in self.buffer.items():
             self.save_file(path, content)
         self.buffer = {}
 
+    def _process_tags_in_pool(self, func, workers: int):
+        '''
+        Process all Markdown-files in a pool of worker processes.
+
+        Yields pairs (path, processed text) in the same order as files are
+        walked. Warnings issued in workers are output here, just before the
+        result of the file they belong to.
+        '''
+        paths = list(_walk_md(self.working_dir))
+        # state of a previous pass may be unpicklable, e.g. a lambda
+        self.current_func = None
+        self.current_pos = 0
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_worker,
+                                 initargs=(self, func.__name__)) as pool:
+            results = pool.map(_process_file_in_worker, paths, chunksize=16)
+            for path, (processed_content, warnings) in zip(paths, results):
+                self._set_current_file(path)
+                for output_message, log_message in warnings:
+                    self._emit_warning(output_message, log_message)
+                yield path, processed_content
+
     def _process_all_files(self,
                            func,
                            log_msg: str = 'Applying preprocessor',
                            buffer: bool = False):
         '''Apply function func to all Markdown-files in the working dir'''
         self.logger.info(log_msg)
-        for markdown_file_path in self.working_dir.rglob('*.md'):
-            self.current_filepath = Path(markdown_file_path)
-            self.current_filename = str(self.current_filepath.
-                                        relative_to(self.working_dir))
+        for markdown_file_path in _walk_md(self.working_dir):
+            self._set_current_file(markdown_file_path)
 
-            with open(markdown_file_path,
-                      encoding='utf8') as markdown_file:
-                content = markdown_file.read()
+            content = markdown_file_path.read_text(encoding='utf8')
 
             processed_content = func(content)
-            if isinstance(processed_content, str):
+            if isinstance(processed_content, str) and \
+                    processed_content != content:
                 if buffer:
                     self.buffer[markdown_file_path] = processed_content
                 else:
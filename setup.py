@@ -16,7 +16,7 @@ setup(
     description=SHORT_DESCRIPTION,
     long_description=LONG_DESCRIPTION,
     long_description_content_type='text/markdown',
-    version='1.0.5',
+    version='1.0.6',
     author='Daniil Minukhin',
     author_email='ddddsa@gmail.com',
     url='https://github.com/foliant-docs/foliantcontrib.utils.preprocessor_ext',
@@ -28,6 +28,9 @@ setup(
         'foliantcontrib.meta>=1.2.3',
         'PyYAML'
     ],
+    extras_require={
+        'regex': ['regex']
+    },
     classifiers=[
         "Development Status :: 5 - Production/Stable",
         "Environment :: Console",